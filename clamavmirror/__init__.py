@@ -65,27 +65,24 @@ import os
 import pwd
 import grp
 import sys
+import json
+import mmap
 import time
 import fcntl
 import hashlib
 
-from shutil import move
+from shutil import copyfileobj
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor, wait
 
-# Queue is called queue in python3
-if sys.version_info.major < 3:
-    from Queue import Queue
-else:
-    from queue import Queue
-
-from threading import Thread
 from optparse import OptionParser
-from subprocess import PIPE, Popen
 
 import certifi
 
-from urllib3 import PoolManager, Timeout
+from urllib3 import PoolManager, Retry, Timeout
+from urllib3.exceptions import ProtocolError, ReadTimeoutError
 from urllib3.util.request import make_headers
-from dns.resolver import query, NXDOMAIN
+from dns.resolver import Resolver, NXDOMAIN
 
 
 VERSION_INFO = (0, 0, 5)
@@ -94,31 +91,50 @@ __copyright__ = "© 2016-2023 Andrew Colin Kissa"
 __email__ = "andrew@topdog.za.net"
 __version__ = ".".join(map(str, VERSION_INFO))
 
+CVD_HEADER_SIZE = 512
+
+try:
+    hashlib.md5()
+    _MD5_CTOR = hashlib.md5
+except BaseException:
+    _MD5_CTOR = partial(hashlib.new, 'md5', usedForSecurity=False)
+
+RETRIES = Retry(total=5, backoff_factor=0.5,
+                status_forcelist=[500, 502, 503, 504],
+                allowed_methods=['GET'], raise_on_status=False)
+
+# RETRIES does not cover a body that breaks off mid-stream
+STREAM_RETRIES = 3
+
+
+def get_fileobj_md5(afile, offset=0):
+    """Get an open file's MD5, skipping the first offset bytes"""
+    if hasattr(hashlib, 'file_digest'):
+        afile.seek(offset)
+        return hashlib.file_digest(afile, _MD5_CTOR).hexdigest()
+    hasher = _MD5_CTOR()
+    if os.fstat(afile.fileno()).st_size > offset:
+        mapped = mmap.mmap(afile.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            with memoryview(mapped)[offset:] as view:
+                hasher.update(view)
+        finally:
+            mapped.close()
+    return hasher.hexdigest()
+
 
 def get_file_md5(filename):
     """Get a file's MD5"""
     if os.path.exists(filename):
-        blocksize = 65536
-        try:
-            hasher = hashlib.md5()
-        except BaseException:
-            hasher = hashlib.new('md5', usedForSecurity=False)
         with open(filename, 'rb') as afile:
-            buf = afile.read(blocksize)
-            while len(buf) > 0:  # pylint: disable=len-as-condition
-                hasher.update(buf)
-                buf = afile.read(blocksize)
-        return hasher.hexdigest()
+            return get_fileobj_md5(afile)
 
     return ''
 
 
 def get_md5(string):
     """Get a string's MD5"""
-    try:
-        hasher = hashlib.md5()
-    except BaseException:
-        hasher = hashlib.new('md5', usedForSecurity=False)
+    hasher = _MD5_CTOR()
     hasher.update(string.encode('utf-8'))
     return hasher.hexdigest()
 
@@ -133,9 +149,39 @@ def info(msg):
     print(msg, file=sys.stdout)
 
 
+def copy_file(source, dest):
+    """Copy a file, in the kernel where possible"""
+    with open(source, 'rb') as sfile, open(dest, 'wb') as dfile:
+        try:
+            remaining = os.fstat(sfile.fileno()).st_size
+            while remaining > 0:
+                copied = os.copy_file_range(
+                    sfile.fileno(), dfile.fileno(), remaining)
+                if not copied:
+                    break
+                remaining -= copied
+            return
+        except (AttributeError, OSError):
+            sfile.seek(0)
+            dfile.seek(0)
+            dfile.truncate()
+        copyfileobj(sfile, dfile, 65536)
+
+
 def deploy_signature(source, dest, user=None, group=None):
     """Deploy a signature fole"""
-    move(source, dest)
+    try:
+        os.rename(source, dest)
+    except OSError:
+        partfile = '%s.part' % dest
+        try:
+            copy_file(source, partfile)
+            os.rename(partfile, dest)
+        except BaseException:
+            if os.path.exists(partfile):
+                os.unlink(partfile)
+            raise
+        os.unlink(source)
     os.chmod(dest, 0o644)
     if user and group:
         try:
@@ -152,13 +198,55 @@ def create_file(name, content):
         writefile.write(content)
 
 
-def get_txt_record(hostname):
-    """Get the text record"""
+def load_state(workdir):
+    """Load the state saved by the previous run"""
+    filename = os.path.join(workdir, 'state.json')
+    try:
+        with open(filename) as handle:
+            return json.load(handle)
+    except (IOError, ValueError):
+        return {}
+
+
+def save_state(workdir, state):
+    """Save state for the next run"""
+    create_file(os.path.join(workdir, 'state.json'), json.dumps(state))
+
+
+def get_txt_record(resolver, hostname):
+    """Get the text record and its TTL"""
+    # dnspython < 2.0 only has query()
+    lookup = getattr(resolver, 'resolve', None) or resolver.query
     try:
-        answers = query(hostname, 'TXT')
-        return answers[0].strings[0].decode()
+        answers = lookup(hostname, 'TXT')
+        return answers[0].strings[0].decode(), answers.rrset.ttl
     except (IndexError, NXDOMAIN):
-        return ''
+        return '', 0
+
+
+def read_cvd_header(afile):
+    """Read the fields of a CVD file header
+
+    ClamAV-VDB:time:version:sigs:flevel:md5:dsig:builder:stime
+    """
+    header = afile.read(CVD_HEADER_SIZE)
+    fields = header.decode('ascii', 'replace').rstrip(' \0').split(':')
+    if len(fields) < 9 or fields[0] != 'ClamAV-VDB' \
+            or not fields[2].isdigit():
+        return None
+    return fields
+
+
+def cvd_stat(filename):
+    """Get the version of a CVD file and whether its MD5 is valid"""
+    if not os.path.exists(filename):
+        return None, False
+    with open(filename, 'rb') as afile:
+        header = read_cvd_header(afile)
+        if header is None:
+            return None, False
+        md5 = get_fileobj_md5(afile, CVD_HEADER_SIZE)
+    return int(header[2]), md5 == header[5]
 
 
 def get_local_version(sigdir, sig):
@@ -166,88 +254,115 @@ def get_local_version(sigdir, sig):
     version = None
     filename = os.path.join(sigdir, '%s.cvd' % sig)
     if os.path.exists(filename):
-        cmd = ['sigtool', '-i', filename]
-        sigtool = Popen(cmd, stdout=PIPE, stderr=PIPE)
-        while True:
-            line = sigtool.stdout.readline().decode()
-            if line and line.startswith('Version:'):
-                version = line.split()[1]
-                break
-            if not line:
-                break
-        sigtool.wait()
+        with open(filename, 'rb') as afile:
+            header = read_cvd_header(afile)
+        if header:
+            version = int(header[2])
     return version
 
 
-def verify_sigfile(sigdir, sig):
-    """Verify a signature file"""
-    cmd = ['sigtool', '-i', '%s/%s.cvd' % (sigdir, sig)]
-    sigtool = Popen(cmd, stdout=PIPE, stderr=PIPE)
-    ret_val = sigtool.wait()
-    return ret_val == 0
+def get_manager(maxsize):
+    """Get a connection pool manager shared by all workers"""
+    useagent = 'ClamAV/0.103.0 (OS: linux-gnu, ARCH: x86_64, CPU: x86_64)'
+    return PoolManager(
+        headers=make_headers(user_agent=useagent),
+        cert_reqs='CERT_REQUIRED',
+        ca_certs=certifi.where(),
+        timeout=Timeout(connect=10.0, read=60.0),
+        maxsize=maxsize,
+        block=False
+    )
+
+
+def get_stagefile(opts, name):
+    """Get the path a download is kept at until it is deployed
 
+    Downloads are staged in the mirror directory, under a .tmp name,
+    when the work directory is on another filesystem so deploying
+    them is a rename instead of a copy.
+    """
+    if os.stat(opts.workdir).st_dev == os.stat(opts.mirrordir).st_dev:
+        return os.path.join(opts.workdir, name)
+    return os.path.join(opts.mirrordir, '%s.tmp' % name)
 
-# pylint: disable=unused-argument
-def check_download(obj, *args, **kwargs):
-    """Verify a download"""
-    version = args[0]
-    workdir = args[1]
-    signame = args[2]
-    if version:
-        local_version = get_local_version(workdir, signame)
-        if not verify_sigfile(workdir, signame) or version != local_version:
-            error("[-] \033[91mFailed to verify signature: %s from: %s\033[0m"
-                  % (signame, obj.url))
-            raise ValueError('Failed to verify signature: %s' % signame)
 
+def download_sig(opts, manager, sig, isdiff, headers=None):
+    """Download signature from hostname
 
-def download_sig(opts, sig, version=None):
-    """Download signature from hostname"""
+    Returns whether the file was downloaded, the status code and the
+    response's ETag and Last-Modified validators.
+    """
     code = None
     downloaded = False
-    useagent = 'ClamAV/0.103.0 (OS: linux-gnu, ARCH: x86_64, CPU: x86_64)'
-    manager = PoolManager(
-        headers=make_headers(user_agent=useagent),
-        cert_reqs='CERT_REQUIRED',
-        ca_certs=certifi.where(),
-        timeout=Timeout(connect=10.0, read=60.0)
-    )
-    if version:
-        path = '/%s.cvd' % sig
-        filename = os.path.join(opts.workdir, '%s.cvd' % sig)
-    else:
+    if isdiff:
         path = '/%s.cdiff' % sig
-        filename = os.path.join(opts.workdir, '%s.cdiff' % sig)
-    try:
-        req = manager.request('GET', 'http://%s%s' % (opts.hostname, path))
-    except BaseException as msg:
-        error("Request error: %s" % msg)
-    data = req.data
-    code = req.status
-    if req.status == 200:
-        with open(filename, 'wb') as handle:
-            handle.write(data)
-        downloaded = os.path.exists(filename)
-    return downloaded, code
+    else:
+        path = '/%s.cvd' % sig
+    filename = get_stagefile(opts, path[1:])
+    partfile = '%s.part' % filename
+    reqheaders = dict(manager.headers)
+    if headers:
+        reqheaders.update(headers)
+    url = 'http://%s%s' % (opts.hostname, path)
+    for passno in range(1, STREAM_RETRIES + 1):
+        try:
+            req = manager.request('GET', url, headers=reqheaders,
+                                  retries=RETRIES, preload_content=False)
+        except BaseException as msg:
+            error("Request error: %s" % msg)
+            return downloaded, code, {}
+        try:
+            if req.status != 200:
+                req.drain_conn()
+                return downloaded, req.status, {}
+            with open(partfile, 'wb') as handle:
+                for chunk in req.stream(65536):
+                    handle.write(chunk)
+            os.rename(partfile, filename)
+            validators = {}
+            for name in ['ETag', 'Last-Modified']:
+                if name in req.headers:
+                    validators[name.lower()] = req.headers[name]
+            return os.path.exists(filename), req.status, validators
+        except (ProtocolError, ReadTimeoutError) as msg:
+            error("=> Download interrupted: %s pass: %d: %s"
+                  % (sig, passno, msg))
+        except BaseException as msg:
+            error("Request error: %s" % msg)
+            return downloaded, code, {}
+        finally:
+            req.release_conn()
+            if os.path.exists(partfile):
+                os.unlink(partfile)
+    return downloaded, code, {}
 
 
 def get_record(opts):
     """Get record"""
     count = 1
+    state = load_state(opts.workdir)
+    record = state.get('record')
+    if record and state.get('expires', 0) > time.time():
+        info("[+] \033[92mUsing cached TXT record:\033[0m %s" % record)
+        return record
+    resolver = Resolver()
     for passno in range(1, 5):
         count = passno
         info("[+] \033[92mQuerying TXT record:\033[0m %s pass: %s" %
              (opts.txtrecord, passno))
-        record = get_txt_record(opts.txtrecord)
+        record, ttl = get_txt_record(resolver, opts.txtrecord)
         if record:
             info("=> Query returned: %s" % record)
             break
-        else:
+        elif passno < 4:
             info("=> Txt record query failed, sleeping 5 secs")
             time.sleep(5)
     if not record:
         error("=> Txt record query failed after %d tries" % count)
         sys.exit(3)
+    state['record'] = record
+    state['expires'] = time.time() + ttl
+    save_state(opts.workdir, state)
     return record
 
 
@@ -255,124 +370,150 @@ def copy_sig(sig, opts, isdiff):
     """Deploy a sig"""
     info("[+] \033[92mDeploying signature:\033[0m %s" % sig)
     if isdiff:
-        sourcefile = os.path.join(opts.workdir, '%s.cdiff' % sig)
-        destfile = os.path.join(opts.mirrordir, '%s.cdiff' % sig)
+        name = '%s.cdiff' % sig
     else:
-        sourcefile = os.path.join(opts.workdir, '%s.cvd' % sig)
-        destfile = os.path.join(opts.mirrordir, '%s.cvd' % sig)
+        name = '%s.cvd' % sig
+    sourcefile = get_stagefile(opts, name)
+    destfile = os.path.join(opts.mirrordir, name)
     deploy_signature(sourcefile, destfile, opts.user, opts.group)
     info("=> Deployed signature: %s" % sig)
 
 
-def update_sig(queue):
-    """update signature"""
-    while True:
-        options, sign, vers = queue.get()
-        info("[+] \033[92mChecking signature version:\033[0m %s" % sign)
-        localver = get_local_version(options.mirrordir, sign)
-        remotever = vers[sign]
-        if localver is None or (localver and int(localver) < int(remotever)):
-            info("=> Update required local: %s => remote: %s" %
-                 (localver, remotever))
-            info("=> Downloading signature: %s" % sign)
-            status, code = download_sig(options, sign, remotever)
-            if status:
-                info("=> Downloaded signature: %s" % sign)
-                copy_sig(sign, options, 0)
-            else:
-                if code == 404:
-                    error("=> \033[91mSignature:\033[0m %s not found" % sign)
-                error("=> \033[91mDownload failed:\033[0m %s code: %d"
-                      % (sign, code))
+def update_sig(options, manager, versions, validators, sign):
+    """update signature
+
+    Returns the validators of a newly deployed signature so the next
+    run can make a conditional request for it.
+    """
+    info("[+] \033[92mChecking signature version:\033[0m %s" % sign)
+    localver = get_local_version(options.mirrordir, sign)
+    remotever = versions[sign]
+    if localver is None or localver < remotever:
+        info("=> Update required local: %s => remote: %s" %
+             (localver, remotever))
+        info("=> Downloading signature: %s" % sign)
+        headers = {}
+        if validators and validators.get('version') == localver:
+            if 'etag' in validators:
+                headers['If-None-Match'] = validators['etag']
+            if 'last-modified' in validators:
+                headers['If-Modified-Since'] = validators['last-modified']
+        status, code, received = download_sig(
+            options, manager, sign, 0, headers)
+        if status:
+            info("=> Downloaded signature: %s" % sign)
+            filename = get_stagefile(options, '%s.cvd' % sign)
+            version, verified = cvd_stat(filename)
+            if not verified or version != remotever:
+                error("=> \033[91mFailed to verify signature:\033[0m %s "
+                      "version: %s" % (sign, version))
+                os.unlink(filename)
+                return None
+            copy_sig(sign, options, 0)
+            received['version'] = version
+            return received
+        if code == 304:
+            error("=> \033[91mServer still has the old signature:\033[0m %s"
+                  % sign)
         else:
-            info(
-                "=> No update required L: %s => R: %s" % (localver, remotever))
-        queue.task_done()
+            if code == 404:
+                error("=> \033[91mSignature:\033[0m %s not found" % sign)
+            error("=> \033[91mDownload failed:\033[0m %s code: %s"
+                  % (sign, code))
+    else:
+        info(
+            "=> No update required L: %s => R: %s" % (localver, remotever))
 
 
-def update_diff(opts, sig):
+def update_diff(opts, manager, sig):
     """Update diff"""
-    for _ in range(1, 6):
-        info("[+] \033[92mDownloading cdiff:\033[0m %s" % sig)
-        status, code = download_sig(opts, sig)
-        if status:
-            info("=> Downloaded cdiff: %s" % sig)
-            copy_sig(sig, opts, 1)
-        else:
-            if code == 404:
-                error("=> \033[91mSignature:\033[0m %s not found" % sig)
-            error("=> \033[91mDownload failed:\033[0m %s code: %d"
-                  % (sig, code))
+    info("[+] \033[92mDownloading cdiff:\033[0m %s" % sig)
+    status, code, _ = download_sig(opts, manager, sig, 1)
+    if status:
+        info("=> Downloaded cdiff: %s" % sig)
+        copy_sig(sig, opts, 1)
+    else:
+        if code == 404:
+            error("=> \033[91mSignature:\033[0m %s not found" % sig)
+        error("=> \033[91mDownload failed:\033[0m %s code: %s"
+              % (sig, code))
 
 
-def create_dns_file(opts, record):
+def create_dns_file(opts, record, remotemd5):
     """Create the DNS record file"""
     info("[+] \033[92mUpdating dns.txt file\033[0m")
     filename = os.path.join(opts.mirrordir, 'dns.txt')
-    localmd5 = get_file_md5(filename)
-    remotemd5 = get_md5(record)
+    state = load_state(opts.workdir)
+    if state.get('dnsmd5') == remotemd5 and os.path.exists(filename):
+        localmd5 = remotemd5
+    else:
+        localmd5 = get_file_md5(filename)
     if localmd5 != remotemd5:
         create_file(filename, record)
         info("=> dns.txt file updated")
     else:
         info("=> No update required L: %s => R: %s" % (localmd5, remotemd5))
+    state['dnsmd5'] = remotemd5
+    save_state(opts.workdir, state)
 
 
-def download_diffs(queue):
-    """Download the cdiff files"""
-    while True:
-        options, signature_type, localver, remotever = queue.get()
-        for num in range(int(localver), int(remotever) + 1):
-            sig_diff = '%s-%d' % (signature_type, num)
-            filename = os.path.join(options.mirrordir, '%s.cdiff' % sig_diff)
-            if not os.path.exists(filename):
-                update_diff(options, sig_diff)
-        queue.task_done()
+def download_diff(options, manager, sig_diff):
+    """Download a cdiff file"""
+    filename = get_stagefile(options, '%s.cdiff' % sig_diff)
+    if os.path.exists(filename):
+        copy_sig(sig_diff, options, 1)
+    else:
+        update_diff(options, manager, sig_diff)
 
 
 def work(options):
     """The work functions"""
     # pylint: disable=too-many-locals
     record = get_record(options)
+    remotemd5 = get_md5(record)
     _, mainv, dailyv, _, _, _, safebrowsingv, bytecodev = record.split(':')
-    versions = {'main': mainv, 'daily': dailyv,
-                'safebrowsing': safebrowsingv,
-                'bytecode': bytecodev}
-    dqueue = Queue(maxsize=0)
-    dqueue_workers = 3
-    info("[+] \033[92mStarting workers\033[0m")
-    for index in range(dqueue_workers):
-        info("=> Starting diff download worker: %d" % (index + 1))
-        worker = Thread(target=download_diffs, args=(dqueue,))
-        worker.setDaemon(True)
-        worker.start()
-    mqueue = Queue(maxsize=0)
-    mqueue_workers = 4
-    for index in range(mqueue_workers):
-        info("=> Starting signature download worker: %d" % (index + 1))
-        worker = Thread(target=update_sig, args=(mqueue,))
-        worker.setDaemon(True)
-        worker.start()
-    for signature_type in ['main', 'daily', 'bytecode', 'safebrowsing']:
-        if signature_type in ['daily', 'bytecode', 'safebrowsing']:
-            # cdiff downloads
-            localver = get_local_version(options.mirrordir, signature_type)
-            remotever = versions[signature_type]
-            if localver is not None:
-                dqueue.put(
-                    (
-                        options,
-                        signature_type,
-                        localver,
-                        remotever
-                    )
-                )
-        mqueue.put((options, signature_type, versions))
-    info("=> Waiting on workers to complete tasks")
-    dqueue.join()
-    mqueue.join()
-    info("=> Workers done processing queues")
-    create_dns_file(options, record)
+    versions = {'main': int(mainv), 'daily': int(dailyv),
+                'safebrowsing': int(safebrowsingv),
+                'bytecode': int(bytecodev)}
+    diffs = []
+    for signature_type in ['daily', 'bytecode', 'safebrowsing']:
+        # cdiff downloads
+        localver = get_local_version(options.mirrordir, signature_type)
+        remotever = versions[signature_type]
+        if localver is not None:
+            for num in range(localver, remotever + 1):
+                sig_diff = '%s-%d' % (signature_type, num)
+                filename = os.path.join(
+                    options.mirrordir, '%s.cdiff' % sig_diff)
+                if not os.path.exists(filename):
+                    diffs.append(sig_diff)
+    sigs = ['main', 'daily', 'bytecode', 'safebrowsing']
+    workers = min(7, len(sigs) + len(diffs))
+    manager = get_manager(workers)
+    info("[+] \033[92mStarting %d workers\033[0m" % workers)
+    state = load_state(options.workdir)
+    validators = state.get('validators', {})
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        sigtasks = dict(
+            (sig, executor.submit(update_sig, options, manager, versions,
+                                  validators.get(sig), sig))
+            for sig in sigs)
+        tasks = list(sigtasks.values())
+        tasks.extend(
+            executor.submit(download_diff, options, manager, sig_diff)
+            for sig_diff in diffs)
+        info("=> Waiting on workers to complete tasks")
+        wait(tasks)
+    for task in tasks:
+        if task.exception() is not None:
+            error("=> \033[91mTask failed:\033[0m %s" % task.exception())
+    info("=> Workers done processing tasks")
+    for sig, task in sigtasks.items():
+        if task.exception() is None and task.result():
+            validators[sig] = task.result()
+    state['validators'] = validators
+    save_state(options.workdir, state)
+    create_dns_file(options, record, remotemd5)
     sys.exit(0)
 
 
@@ -421,13 +562,13 @@ def main():
                       default=False)
     options, _ = parser.parse_args()
     try:
-        lockfile = os.path.join(options.lockdir, 'clamavmirror')
-        with open(lockfile, 'w+') as lock:
-            fcntl.lockf(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
-            work(options)
-    except IOError:
+        # the kernel drops the lock when the process exits
+        lockfd = os.open(options.lockdir, os.O_RDONLY | os.O_DIRECTORY)
+        fcntl.flock(lockfd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except (IOError, OSError):
         info("=> Another instance is already running")
         sys.exit(254)
+    work(options)
 
 
 if __name__ == '__main__':
@@ -57,12 +57,12 @@ def main():
         },
         include_package_data=True,
         zip_safe=False,
-        install_requires=['urllib3', 'dnspython', 'certifi'],
+        install_requires=['urllib3>=1.26', 'dnspython', 'certifi'],
+        python_requires='>=3.6',
         classifiers=[
             'Development Status :: 4 - Beta',
             'Programming Language :: Python',
-            'Programming Language :: Python :: 2.6',
-            'Programming Language :: Python :: 2.7',
+            'Programming Language :: Python :: 3',
             'Programming Language :: Python :: 3.7',
             'Topic :: Software Development :: Libraries :: Python Modules',
             'Intended Audience :: System Administrators',